@@ -1,9 +1,13 @@
 import sys
 import os
-import shlex
+import re
+import signal
+import stat
 import subprocess
 import io
-from contextlib import redirect_stdout, redirect_stderr, contextmanager
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import readline  # Works on Linux/macOS
@@ -16,6 +20,81 @@ except ImportError:
         except ImportError:
             readline = None
 
+try:
+    import fcntl  # Unix only
+except ImportError:
+    fcntl = None
+
+PROMPT = "$ "
+
+# How many unknown command names find_executable remembers
+MISSING_COMMANDS_LIMIT = 256
+
+# How many commands the in-memory history keeps
+HISTORY_LIMIT = 1000
+
+# Most completion matches checked for execute permission; longer lists
+# are only shown, so their names are offered unchecked
+COMPLETION_CHECK_LIMIT = 64
+
+# Threads used to list PATH directories
+PATH_SCAN_WORKERS = 8
+
+# Signals Python ignores at startup; children get their default action
+# back, as subprocess restores it
+CHILD_DEFAULT_SIGNALS = tuple(
+    getattr(signal, name)
+    for name in ("SIGPIPE", "SIGXFSZ", "SIGXFZ")
+    if hasattr(signal, name)
+)
+
+# Kernel capacity requested for pipes between pipeline stages (Linux
+# defaults to 64 KiB)
+PIPE_KERNEL_SIZE = 1 << 20
+
+# Redirection operator -> (file descriptor, open() mode)
+REDIRECTION_OPERATORS = {
+    ">": (1, "w"),
+    "1>": (1, "w"),
+    ">>": (1, "a"),
+    "1>>": (1, "a"),
+    "2>": (2, "w"),
+    "2>>": (2, "a"),
+}
+
+# Characters that end an unquoted run of plain word characters
+PLAIN_RUN = re.compile(r"[^ \t\r\n'\"\\|]+")
+
+# Characters that need the full tokenizer rather than a plain split
+SPECIAL_CHARACTERS = re.compile(r"['\"\\|]")
+
+# Characters that end a run of literal text inside double quotes
+DOUBLE_QUOTED_RUN = re.compile(r'[^"\\]+')
+
+
+class DescriptorWriter:
+    # Stands in for sys.stdout/sys.stderr while a builtin's output is
+    # redirected to a file: the text is collected and written straight to
+    # the descriptor on flush, without building a TextIOWrapper
+    def __init__(self, fd):
+        self.fd = fd
+        self.chunks = []
+
+    def write(self, text):
+        self.chunks.append(text)
+        return len(text)
+
+    def flush(self):
+        data = "".join(self.chunks).encode("utf-8", "surrogateescape")
+        self.chunks.clear()
+
+        while data:
+            data = data[os.write(self.fd, data) :]
+
+    def close(self):
+        # The descriptor belongs to the caller
+        self.flush()
+
 
 class Shell:
     def __init__(self):
@@ -26,56 +105,236 @@ class Shell:
             "pwd": self.execute_pwd,
             "cd": self.execute_cd,
             "history": self.execute_history,
+            "hash": self.execute_hash,
+        }
+        self.history_file_actions = {
+            "-r": self.read_history,
+            "-w": self.write_history,
+            "-a": self.append_history,
         }
         self.continue_repl = True
-        self.command_history = []
+        self.interactive = sys.stdin.isatty()
+        self.command_history = deque(maxlen=self.get_history_limit())
+        # Number of entries the bounded history has discarded, so entry
+        # numbers keep counting up once the oldest ones fall off
+        self.history_offset = 0
         self.last_history_append = 0
+        self.executable_cache = {}
+        self.executable_cache_paths = None
+        # Command name -> path already checked to be executable
+        self.resolved_commands = {}
+        # Directory -> (mtime, {command name: full path})
+        self.directory_listings = {}
+        self.path_directories = None
+        self.path_extensions = None
+        self.path_extension_set = frozenset()
+        self.missing_commands = OrderedDict()
+        self.current_directory = None
+        self.last_parsed_line = None
+        self.last_parsed_specs = []
         self.all_commands = set(self.commands_map.keys())
-        self.refresh_external_commands()
+        # Prefix trie over all_commands, built on the first Tab
+        self.command_trie = None
+        self.completion_text = None
+        self.completion_matches = []
+        # Trie node reached for the last completed prefix
+        self.locus_text = ""
+        self.locus_node = None
         self.setup_autocomplete()
 
     def refresh_external_commands(self):
-        self.external_commands = self.get_executables_in_path()
+        # Maps each command name to the first matching entry on PATH; names
+        # become the `hash` table of bash once resolve_command() has
+        # checked them. A checked name stays resolved while it is still
+        # the first entry of its name, as nothing earlier can shadow it
+        self.executable_cache_paths = self.get_path_directories()
+        self.executable_cache = self.get_executables_in_path()
+        self.resolved_commands = {
+            name: full_path
+            for name, full_path in self.resolved_commands.items()
+            if self.executable_cache.get(name) == full_path
+        }
+        self.external_commands = set(self.executable_cache)
         self.all_commands = set(self.commands_map.keys()) | self.external_commands
+        self.command_trie = None
+        self.completion_text = None
+        self.locus_node = None
+
+    def sync_external_commands(self):
+        # PATH is scanned on first use rather than at startup, so a shell
+        # that only runs builtins never lists it, and again once
+        # forget_executables() has dropped the table
+        if self.get_path_directories() is not self.executable_cache_paths:
+            self.refresh_external_commands()
+            self.missing_commands.clear()
+
+    def get_path_directories(self):
+        # Nothing in this shell can change its own PATH, so it is read once
+        # and again only after forget_executables() or, when PATH has
+        # relative entries, after cd. A builtin that changes PATH must call
+        # forget_executables() so the new value is read. Like execvp(), fall
+        # back to the default search path when PATH is unset; an empty entry
+        # means the current directory, as POSIX specifies. A directory
+        # listed twice, under its own name or through a symlink such as
+        # /bin -> /usr/bin, can only match at its first position, so later
+        # repeats are dropped rather than stat()ed and scanned again
+        if self.path_directories is None:
+            path_env = os.environ.get("PATH", os.defpath)
+            unique_directories = {}
+
+            for directory in path_env.split(os.pathsep):
+                directory = directory or os.curdir
+                real_directory = os.path.realpath(directory)
+                unique_directories.setdefault(real_directory, directory)
+
+            self.path_directories = tuple(unique_directories.values())
+
+        return self.path_directories
+
+    def get_path_extensions(self):
+        # Windows only: PATHEXT in search order, read once like PATH. The
+        # set form lets directory scans test a name's extension directly
+        if self.path_extensions is None:
+            pathext = os.environ.get("PATHEXT", ".EXE;.BAT;.CMD").lower()
+            self.path_extensions = tuple(pathext.split(";"))
+            self.path_extension_set = frozenset(self.path_extensions)
+
+        return self.path_extensions
+
+    def forget_executables(self):
+        # The next lookup re-reads and rescans PATH and drops the
+        # remembered misses
+        self.path_directories = None
+        self.path_extensions = None
+        self.executable_cache_paths = None
+        self.resolved_commands = {}
+        self.directory_listings.clear()
+
+    def forget_relative_directories(self):
+        # After cd, relative PATH entries such as . name other directories.
+        # Only their listings and the commands found through them are
+        # dropped, so the next lookup rescans just those and absolute
+        # directories are answered from memory
+        path_env = os.environ.get("PATH", os.defpath)
+        relative_directories = {
+            directory or os.curdir
+            for directory in path_env.split(os.pathsep)
+            if not os.path.isabs(directory)
+        }
 
-    def get_executables_in_path(self):
-        paths = os.environ.get("PATH", "").split(os.pathsep)
-        executables = set()
+        if not relative_directories:
+            return
 
-        if os.name == "nt":
-            # Windows: consider PATHEXT
-            pathext = os.environ.get("PATHEXT", ".EXE;.BAT;.CMD").lower().split(";")
+        for directory in relative_directories:
+            self.directory_listings.pop(directory, None)
 
-            for directory in paths:
-                if not os.path.isdir(directory):
-                    continue
+        self.resolved_commands = {
+            name: full_path
+            for name, full_path in self.resolved_commands.items()
+            if os.path.isabs(full_path)
+        }
+        # Repeated entries are found through realpath(), which depends on
+        # the current directory, so PATH is read again
+        self.path_directories = None
 
-                for filename in os.listdir(directory):
-                    full_path = os.path.join(directory, filename)
+    def get_executables_in_path(self):
+        paths = self.get_path_directories()
+        executables = {}
+        present = []
+        stale = []
+
+        # A directory's mtime changes whenever an entry is added, removed or
+        # renamed, so unchanged directories are answered from memory
+        for directory in paths:
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                self.directory_listings.pop(directory, None)
+                continue
 
-                    if os.path.isfile(full_path):
-                        _, ext = os.path.splitext(filename)
+            present.append(directory)
+            cached = self.directory_listings.get(directory)
 
-                        if ext.lower() in pathext:
-                            executables.add(filename)
+            if cached is None or cached[0] != mtime:
+                stale.append((directory, mtime))
+
+        # Directory listings block on the filesystem, so cold or remote PATH
+        # entries are read in parallel
+        to_scan = [directory for directory, _ in stale]
+
+        if len(to_scan) > 1:
+            with ThreadPoolExecutor(max_workers=PATH_SCAN_WORKERS) as executor:
+                listings = list(executor.map(self.scan_directory, to_scan))
         else:
-            # Unix-like: any file with execute permission
-            for directory in paths:
-                if not os.path.isdir(directory):
-                    continue
+            listings = [self.scan_directory(directory) for directory in to_scan]
 
-                for filename in os.listdir(directory):
-                    full_path = os.path.join(directory, filename)
-                    if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
-                        executables.add(filename)
+        for (directory, mtime), listing in zip(stale, listings):
+            self.directory_listings[directory] = (mtime, listing)
+
+        # Earlier PATH entries win, exactly as in a sequential search
+        for directory in present:
+            for name, full_path in self.directory_listings[directory][1].items():
+                executables.setdefault(name, full_path)
+
+        return executables
+
+    def scan_directory(self, directory):
+        executables = {}
+
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            return executables
+
+        with entries:
+            if os.name == "nt":
+                # Windows: consider PATHEXT. is_file() is answered from the
+                # directory listing itself, so only the name is checked
+                self.get_path_extensions()
+                pathext = self.path_extension_set
+
+                for entry in entries:
+                    stem, dot, ext = entry.name.rpartition(".")
+
+                    if stem and "." + ext.lower() in pathext and entry.is_file():
+                        executables[entry.name] = entry.path
+            else:
+                # Unix-like: the file type comes with the listing, so regular
+                # files cost no stat(); only symlinks are followed to see
+                # what they point at. Execute permission is checked for the
+                # names that are actually looked up or offered for completion
+                for entry in entries:
+                    try:
+                        if entry.is_file(follow_symlinks=False) or (
+                            entry.is_symlink() and entry.is_file()
+                        ):
+                            executables[entry.name] = entry.path
+                    except OSError:
+                        continue
 
         return executables
 
+    def is_executable(self, path):
+        # A single stat() answers both "regular file?" and "executable?"
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            return False
+
+        return stat.S_ISREG(mode) and bool(mode & 0o111)
+
     def setup_autocomplete(self):
         if readline:
             # Set up autocompletion as before
             def completer(text, state):
-                options = [cmd for cmd in self.all_commands if cmd.startswith(text)]
+                self.sync_external_commands()
+
+                # readline asks for every match of the same text in turn
+                if text != self.completion_text:
+                    self.completion_matches = self.complete_command(text)
+                    self.completion_text = text
+
+                options = self.completion_matches
 
                 if state < len(options):
                     # Only add a space if the completion is unique and not already present
@@ -93,64 +352,214 @@ class Shell:
         else:
             print("Warning: No readline support. Autocompletion is disabled.")
 
-    def parse_command(self, command_str):
-        return shlex.split(command_str)
+    def get_command_trie(self):
+        # Nested dicts keyed by character; the None key holds the name that
+        # ends at that node
+        if self.command_trie is None:
+            root = {}
+
+            for name in self.all_commands:
+                node = root
+
+                for char in name:
+                    node = node.setdefault(char, {})
+
+                node[None] = name
+
+            self.command_trie = root
+
+        return self.command_trie
+
+    def complete_command(self, text):
+        # Walk down to the node for text, then collect only its subtree. As
+        # the user types on, the word usually extends the previous one, so
+        # the walk resumes from where that one ended
+        if self.locus_node is not None and text.startswith(self.locus_text):
+            node = self.locus_node
+            remaining = text[len(self.locus_text) :]
+        else:
+            node = self.get_command_trie()
+            remaining = text
+
+        for char in remaining:
+            node = node.get(char)
+
+            if node is None:
+                return []
+
+        self.locus_text = text
+        self.locus_node = node
+
+        matches = []
+        pending = [node]
+
+        while pending:
+            for key, child in pending.pop().items():
+                if key is None:
+                    matches.append(child)
+                else:
+                    pending.append(child)
+
+        # Only a short list of matches is checked for execute permission,
+        # since one of them may be inserted; a short prefix would otherwise
+        # cost a stat() per PATH entry. Names that pass stay in
+        # resolved_commands for the next Tab
+        if os.name != "nt" and len(matches) <= COMPLETION_CHECK_LIMIT:
+            matches = [
+                name
+                for name in matches
+                if name in self.commands_map
+                or name in self.resolved_commands
+                or self.resolve_command(name)
+            ]
+
+        matches.sort()
+        return matches
+
+    def parse_command_line(self, command_line):
+        # Returns one (args, stdout_file, stdout_mode, stderr_file,
+        # stderr_mode) tuple per pipeline stage. Only the last stage takes
+        # redirections. Lines are often re-issued from history, so the
+        # last result is kept; args are tuples to keep it read-only
+        if command_line != self.last_parsed_line:
+            segments = self.tokenize(command_line)
+            specs = [(tuple(segment), None, None, None, None) for segment in segments]
+            new_args, *redirection = self.parse_redirection(segments[-1])
+            specs[-1] = (tuple(new_args), *redirection)
+            self.last_parsed_specs = specs
+            self.last_parsed_line = command_line
+
+        return self.last_parsed_specs
+
+    def tokenize(self, line):
+        # Splits the line into pipeline segments of words in one pass, using
+        # the rules of shlex.split(): whitespace separates words, single
+        # quotes are literal, double quotes honour \" and \\, and a bare
+        # backslash escapes the next character. An unquoted | ends a segment
+        if SPECIAL_CHARACTERS.search(line) is None:
+            # Without quotes, escapes or pipes every word is a plain run
+            return [PLAIN_RUN.findall(line)]
+
+        segments = []
+        tokens = []
+        current = []
+        in_token = False
+        length = len(line)
+        i = 0
+
+        while i < length:
+            char = line[i]
+
+            if char in " \t\r\n|":
+                if in_token:
+                    tokens.append("".join(current))
+                    current = []
+                    in_token = False
+
+                if char == "|":
+                    segments.append(tokens)
+                    tokens = []
+
+                i += 1
+            elif char == "'":
+                end = line.find("'", i + 1)
+
+                if end == -1:
+                    raise ValueError("No closing quotation")
+
+                current.append(line[i + 1 : end])
+                in_token = True
+                i = end + 1
+            elif char == '"':
+                i += 1
+
+                while i < length and line[i] != '"':
+                    if line[i] == "\\":
+                        if i + 1 >= length:
+                            raise ValueError("No escaped character")
+
+                        if line[i + 1] in '"\\':
+                            i += 1
+
+                        current.append(line[i])
+                        i += 1
+                    else:
+                        end = DOUBLE_QUOTED_RUN.match(line, i).end()
+                        current.append(line[i:end])
+                        i = end
+
+                if i >= length:
+                    raise ValueError("No closing quotation")
+
+                in_token = True
+                i += 1
+            elif char == "\\":
+                if i + 1 >= length:
+                    raise ValueError("No escaped character")
+
+                current.append(line[i + 1])
+                in_token = True
+                i += 2
+            else:
+                end = PLAIN_RUN.match(line, i).end()
+                current.append(line[i:end])
+                in_token = True
+                i = end
+
+        if in_token:
+            tokens.append("".join(current))
+
+        segments.append(tokens)
+
+        return segments
 
     def parse_redirection(self, args):
-        stdout_file = None
-        stdout_mode = None
-        stderr_file = None
-        stderr_mode = None
+        # Most command lines have no redirection at all
+        if REDIRECTION_OPERATORS.keys().isdisjoint(args):
+            return args, None, None, None, None
+
+        redirections = {1: (None, None), 2: (None, None)}
         new_args = []
+        length = len(args)
         i = 0
 
-        while i < len(args):
-            if args[i] == ">" or args[i] == "1>":
-                if i + 1 < len(args):
-                    stdout_file = args[i + 1]
-                    stdout_mode = "w"
-                    i += 2
-                    continue
-            elif args[i] == ">>" or args[i] == "1>>":
-                if i + 1 < len(args):
-                    stdout_file = args[i + 1]
-                    stdout_mode = "a"
-                    i += 2
-                    continue
-            elif args[i] == "2>":
-                if i + 1 < len(args):
-                    stderr_file = args[i + 1]
-                    stderr_mode = "w"
-                    i += 2
-                    continue
-            elif args[i] == "2>>":
-                if i + 1 < len(args):
-                    stderr_file = args[i + 1]
-                    stderr_mode = "a"
-                    i += 2
-                    continue
-            else:
+        while i < length:
+            operator = REDIRECTION_OPERATORS.get(args[i])
+
+            if operator is None:
                 new_args.append(args[i])
+                i += 1
+                continue
 
-            i += 1
+            # An operator without a target is dropped
+            if i + 1 < length:
+                fd, mode = operator
+                redirections[fd] = (args[i + 1], mode)
 
-        return new_args, stdout_file, stdout_mode, stderr_file, stderr_mode
+            i += 2
+
+        stdout_file, stdout_mode = redirections[1]
+        stderr_file, stderr_mode = redirections[2]
 
-    @contextmanager
-    def dummy_cm(self):
-        yield
+        return new_args, stdout_file, stdout_mode, stderr_file, stderr_mode
 
     def find_executable(self, command_name):
-        # On Windows, try with PATHEXT if not found directly
-        paths = os.environ.get("PATH", "").split(os.pathsep)
+        # Paths are resolved directly rather than searched for on PATH. As in
+        # POSIX shells the current directory is searched only through empty
+        # or relative PATH entries; otherwise programs there are run as
+        # ./name, which takes this branch
+        if os.sep in command_name:
+            if self.is_executable(command_name):
+                return command_name
 
+            return None
+
+        # On Windows, try with PATHEXT if not found directly
         if os.name == "nt":
-            pathext = os.environ.get("PATHEXT", ".EXE;.BAT;.CMD").lower().split(";")
+            paths = self.get_path_directories()
+            pathext = self.get_path_extensions()
 
             for directory in paths:
-                if not os.path.isdir(directory):
-                    continue
-
                 for ext in pathext:
                     full_path = os.path.join(directory, command_name)
 
@@ -162,36 +571,196 @@ class Shell:
                     if os.path.isfile(full_path_ext):
                         return full_path_ext
         else:
-            for directory in paths:
-                full_path = os.path.join(directory, command_name)
+            self.sync_external_commands()
+            full_path = self.resolved_commands.get(command_name)
+
+            if full_path is not None:
+                return full_path
+
+            # Typos and probes for optional tools would rescan PATH every
+            # time. A remembered miss only stands while no PATH directory
+            # has changed and no file of that name is listed, since one
+            # may have been made executable in place
+            if (
+                command_name in self.missing_commands
+                and command_name not in self.executable_cache
+                and not self.path_listings_changed()
+            ):
+                self.missing_commands.move_to_end(command_name)
+                return None
+
+            full_path = self.resolve_command(command_name)
+
+            if full_path is None:
+                # The command may have been installed since the last scan
+                self.refresh_external_commands()
+                full_path = self.resolve_command(command_name)
+
+            if full_path is None:
+                self.missing_commands[command_name] = None
+                self.missing_commands.move_to_end(command_name)
+
+                if len(self.missing_commands) > MISSING_COMMANDS_LIMIT:
+                    self.missing_commands.popitem(last=False)
 
-                if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
-                    return full_path
+            return full_path
 
         return None
 
-    def run_executable(
-        self, executable_path, arguments, stdout_file=None, stderr_file=None
+    def path_listings_changed(self):
+        # One stat() per PATH directory: has any directory been changed,
+        # created or removed since its listing was taken?
+        for directory in self.executable_cache_paths:
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                mtime = None
+
+            cached = self.directory_listings.get(directory)
+
+            if (cached[0] if cached else None) != mtime:
+                return True
+
+        return False
+
+    def resolve_command(self, command_name):
+        # Listings hold every non-directory entry, so a name is checked with
+        # one stat() per candidate, in PATH order as execvp() would, and the
+        # first executable one is remembered
+        if command_name not in self.executable_cache:
+            return None
+
+        for directory in self.executable_cache_paths:
+            listing = self.directory_listings.get(directory)
+            full_path = listing and listing[1].get(command_name)
+
+            if full_path and self.is_executable(full_path):
+                self.resolved_commands[command_name] = full_path
+                return full_path
+
+        return None
+
+    def find_executable_again(self, command_name):
+        # A remembered path no longer holds an executable, most likely
+        # because the command was moved or removed; forget it and search
+        # PATH again so the command is found wherever it is now
+        if os.sep in command_name:
+            return None
+
+        self.resolved_commands.pop(command_name, None)
+        return self.find_executable(command_name)
+
+    def spawn_resolved(self, command_name, executable_path, spawn):
+        # Calls spawn(path) and returns (its result or None, the path used).
+        # Cached paths are not stat()ed before use, so a failed spawn whose
+        # path is gone is retried once with a fresh lookup
+        try:
+            return spawn(executable_path), executable_path
+        except Exception:
+            if self.is_executable(executable_path):
+                return None, executable_path
+
+        executable_path = self.find_executable_again(command_name)
+
+        if executable_path is None:
+            return None, None
+
+        try:
+            return spawn(executable_path), executable_path
+        except Exception:
+            return None, executable_path
+
+    def spawn_executable(self, executable_path, arguments, file_actions=()):
+        # Skips subprocess' pipe and signal bookkeeping; the file actions
+        # open or dup2 the child's standard streams during the spawn
+        return os.posix_spawn(
+            executable_path,
+            arguments,
+            os.environ,
+            file_actions=list(file_actions),
+            setsigdef=CHILD_DEFAULT_SIGNALS,
+        )
+
+    def redirection_actions(
+        self, stdout_file=None, stdout_mode=None, stderr_file=None, stderr_mode=None
     ):
-        kwargs = {"text": True}
+        # The child opens its redirection targets itself, so the shell never
+        # opens them in Python
+        file_actions = []
+
+        for fd, file_path, mode in (
+            (1, stdout_file, stdout_mode),
+            (2, stderr_file, stderr_mode),
+        ):
+            if file_path:
+                flags = self.redirection_flags(mode)
+                file_actions.append((os.POSIX_SPAWN_OPEN, fd, file_path, flags, 0o666))
+
+        return file_actions
+
+    def start_stage(self, executable_path, arguments, stdin, stdout, stderr):
+        # Returns a pid, or a Popen where posix_spawn is unavailable
+        if not hasattr(os, "posix_spawn"):
+            return subprocess.Popen(
+                arguments,
+                executable=executable_path,
+                stdin=stdin,
+                stdout=stdout,
+                stderr=stderr,
+            )
 
-        if stdout_file:
-            kwargs["stdout"] = stdout_file
-        else:
-            kwargs["stdout"] = subprocess.PIPE
+        file_actions = [
+            (os.POSIX_SPAWN_DUP2, fd, target)
+            for fd, target in ((stdin, 0), (stdout, 1), (stderr, 2))
+            if fd is not None
+        ]
+
+        return self.spawn_executable(executable_path, arguments, file_actions)
 
-        if stderr_file:
-            kwargs["stderr"] = stderr_file
+    def wait_stage(self, stage):
+        if isinstance(stage, int):
+            os.waitpid(stage, 0)
         else:
-            kwargs["stderr"] = subprocess.PIPE
+            stage.wait()
+
+    def redirection_flags(self, mode):
+        flags = os.O_WRONLY | os.O_CREAT
+        flags |= os.O_APPEND if mode == "a" else os.O_TRUNC
+        return flags
+
+    def open_redirection(self, file_path, mode):
+        # External commands only need the descriptor, so no text layer is
+        # built unless a builtin writes to it (see wrap_redirection)
+        return os.open(file_path, self.redirection_flags(mode), 0o666)
+
+    def redirection_error(self, stdout_file, stdout_mode, stderr_file, stderr_mode):
+        # posix_spawn does not say which file action failed, so after a
+        # failed spawn the targets are opened here to find the culprit
+        for file_path, mode in ((stdout_file, stdout_mode), (stderr_file, stderr_mode)):
+            if file_path:
+                try:
+                    os.close(self.open_redirection(file_path, mode))
+                except OSError as e:
+                    return f"{e.filename}: {e.strerror}"
 
-        result = subprocess.run(arguments, executable=executable_path, **kwargs)
+        return None
+
+    def wrap_redirection(self, fd):
+        # Builtins never flush, so their output reaches the file in one
+        # os.write() when run_pipeline closes the wrapper; the descriptor
+        # itself stays owned by run_pipeline
+        return DescriptorWriter(fd)
 
-        if not stdout_file and result.stdout:
-            sys.stdout.write(result.stdout)
+    def grow_pipe(self, fd):
+        # A roomier pipe stalls a fast writer less often; only Linux lets
+        # us resize it, and the request is best effort
+        if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+            return
 
-        if not stderr_file and result.stderr:
-            sys.stderr.write(result.stderr)
+        try:
+            fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, PIPE_KERNEL_SIZE)
+        except OSError:
+            pass
 
     # Built-in command implementations
     def execute_exit(self, args):
@@ -201,7 +770,16 @@ class Shell:
             self.continue_repl = False
 
     def execute_echo(self, args):
-        print(" ".join(args[1:]))
+        sys.stdout.write(" ".join(args[1:]) + "\n")
+
+    def execute_hash(self, args):
+        if len(args) > 1 and args[1] == "-r":
+            self.forget_executables()
+            return
+
+        for name in args[1:]:
+            if self.find_executable(name) is None:
+                print(f"hash: {name}: not found")
 
     def execute_history(self, args):
         try:
@@ -214,12 +792,10 @@ class Shell:
         except IndexError:
             file_path = None
 
-        if functional_parameter == "-r" and file_path is not None:
-            self.read_history(file_path)
-        elif functional_parameter == "-w" and file_path is not None:
-            self.write_history(file_path)
-        elif functional_parameter == "-a" and file_path is not None:
-            self.append_history(file_path)
+        history_file_action = self.history_file_actions.get(functional_parameter)
+
+        if history_file_action is not None and file_path is not None:
+            history_file_action(file_path)
         else:
             self.list_history(functional_parameter)
 
@@ -230,12 +806,16 @@ class Shell:
             except Exception as e:
                 pass
                 # print(f"Error reading history file: {e}")
+
+            self.trim_history()
         else:
             # Fallback: load into self.command_history if you want
             try:
                 with open(file_path, "r") as f:
-                    for line in f:
-                        self.command_history.append(line.rstrip("\n"))
+                    commands = f.read().splitlines()
+
+                for command in commands:
+                    self.add_history(command)
             except Exception as e:
                 pass
                 # print(f"Error reading history file: {e}")
@@ -250,54 +830,109 @@ class Shell:
                 pass
                 # print(f"Error writing history file: {e}")
         else:
-            # Fallback: save self.command_history
+            # Fallback: save self.command_history in a single os.write()
             try:
-                with open(file_path, "w") as f:
-                    for cmd in self.command_history:
-                        f.write(cmd + "\n")
-            except Exception as e:
-                pass
-                # print(f"Error writing history file: {e}")
+                fd = self.open_redirection(file_path, "w")
+            except OSError:
+                fd = None
+
+            if fd is not None:
+                try:
+                    writer = self.wrap_redirection(fd)
+                    writer.write("".join(f"{cmd}\n" for cmd in self.command_history))
+                    writer.close()
+                except OSError:
+                    pass
+                finally:
+                    os.close(fd)
 
         self.last_history_append = self.get_history_length()
 
+    def get_history_limit(self):
+        # HISTSIZE as in bash: a negative value means unlimited
+        try:
+            history_limit = int(os.environ.get("HISTSIZE", HISTORY_LIMIT))
+        except ValueError:
+            return HISTORY_LIMIT
+
+        return history_limit if history_limit >= 0 else None
+
+    def add_history(self, command):
+        if readline and hasattr(readline, "get_history_item"):
+            # input() has already put the line into readline's own list
+            self.trim_history()
+            return
+
+        if len(self.command_history) == self.command_history.maxlen:
+            self.history_offset += 1
+
+        self.command_history.append(command)
+
+    def trim_history(self):
+        # readline's list would otherwise grow without bound, so it is held
+        # to the same limit as command_history, with dropped entries counted
+        # in history_offset to keep the numbering
+        limit = self.command_history.maxlen
+        length = readline.get_current_history_length()
+
+        if limit is None or length <= limit:
+            return
+
+        excess = length - limit
+
+        if excess == 1:
+            readline.remove_history_item(0)
+        else:
+            # Removing from the front shifts the whole list each time
+            kept = [readline.get_history_item(i) for i in range(excess + 1, length + 1)]
+            readline.clear_history()
+
+            for command in kept:
+                readline.add_history(command)
+
+        self.history_offset += excess
+
     def get_history_length(self):
         if readline and hasattr(readline, "get_history_item"):
-            return readline.get_current_history_length()
+            return self.history_offset + readline.get_current_history_length()
         else:
-            return len(self.command_history)
+            return self.history_offset + len(self.command_history)
 
     def append_history(self, file_path):
         total = self.get_history_length()
 
         if readline and hasattr(readline, "get_history_item"):
-            try:
-                with open(file_path, "a") as f:
-                    for i in range(self.last_history_append, total):
-                        cmd = readline.get_history_item(i + 1)
-                        if cmd is not None:
-                            f.write(cmd + "\n")
-                self.last_history_append = total
-            except Exception as e:
-                pass
-                # print(f"Error appending history file: {e}")
+            get_item = lambda i: readline.get_history_item(i - self.history_offset + 1)
         else:
-            try:
-                with open(file_path, "a") as f:
-                    for i in range(self.last_history_append, total):
-                        f.write(self.command_history[i] + "\n")
-                self.last_history_append = total
-            except Exception as e:
-                pass
-                # print(f"Error appending history file: {e}")
+            get_item = lambda i: self.command_history[i - self.history_offset]
+
+        start = max(self.last_history_append, self.history_offset)
+        commands = (get_item(i) for i in range(start, total))
+
+        # The new entries are gathered first and reach the file in a single
+        # os.write() through the same path as builtin redirections
+        try:
+            fd = self.open_redirection(file_path, "a")
+        except OSError:
+            return
+
+        try:
+            writer = self.wrap_redirection(fd)
+            writer.write("".join(f"{cmd}\n" for cmd in commands if cmd is not None))
+            writer.close()
+            self.last_history_append = total
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
 
     def list_history(self, n):
+        total = self.get_history_length()
+
         if readline and hasattr(readline, "get_history_item"):
-            total = readline.get_current_history_length()
-            get_item = lambda i: readline.get_history_item(i + 1)
+            get_item = lambda i: readline.get_history_item(i - self.history_offset + 1)
         else:
-            total = len(self.command_history)
-            get_item = lambda i: self.command_history[i]
+            get_item = lambda i: self.command_history[i - self.history_offset]
 
         try:
             entry_limiter = int(n)
@@ -308,213 +943,342 @@ class Shell:
         if start_entry < 0:
             start_entry = 0
 
-        for i in range(start_entry, total):
-            cmd = get_item(i)
-            print(f"    {i+1}  {cmd}")
+        start_entry = max(start_entry, self.history_offset)
+
+        sys.stdout.write(
+            "".join(f"    {i+1}  {get_item(i)}\n" for i in range(start_entry, total))
+        )
 
     def execute_type(self, args):
         if len(args) < 2:
-            print("type: missing argument")
+            sys.stdout.write("type: missing argument\n")
+            return
 
         type_target = args[1]
 
         if type_target in self.commands_map:
-            print(f"{type_target} is a shell builtin")
+            sys.stdout.write(f"{type_target} is a shell builtin\n")
         else:
             path_directory = self.find_executable(type_target)
 
+            if path_directory is not None and not self.is_executable(path_directory):
+                path_directory = self.find_executable_again(type_target)
+
             if path_directory is None:
-                print(f"{type_target}: not found")
+                sys.stdout.write(f"{type_target}: not found\n")
             else:
-                print(f"{type_target} is {path_directory}")
+                sys.stdout.write(f"{type_target} is {path_directory}\n")
+
+    def get_current_directory(self):
+        # Only cd changes the working directory, so ask the kernel once
+        if self.current_directory is None:
+            self.current_directory = os.getcwd()
+
+        return self.current_directory
 
     def execute_pwd(self, args):
-        print(os.getcwd())
+        sys.stdout.write(self.get_current_directory() + "\n")
 
     def execute_cd(self, args):
         if len(args) < 2:
-            print("cd: missing argument")
+            cd_target = os.environ.get("HOME") or os.path.expanduser("~")
+        else:
+            cd_target = args[1]
 
-        cd_target = args[1]
+        # The kernel resolves relative paths against the current directory,
+        # so only ~ needs expanding before chdir
+        if cd_target.startswith("~"):
+            directory = os.path.expanduser(cd_target)
+        else:
+            directory = cd_target
 
         try:
-            os.chdir(os.path.expanduser(cd_target))
+            os.chdir(directory)
         except FileNotFoundError:
             print(f"cd: {cd_target}: No such file or directory")
+            return
+        except OSError as e:
+            print(f"cd: {cd_target}: {e.strerror}")
+            return
 
-    def old_main_loop(self):
-        while self.continue_repl:
-            try:
-                command = input("$ ")
-            except EOFError:
-                print()
-                break
-
-            parsed_command = self.parse_command(command)
-            parsed_command, stdout_file, stdout_mode, stderr_file, stderr_mode = (
-                self.parse_redirection(parsed_command)
-            )
+        # chdir() resolves symlinks physically, which a textual join of the
+        # old and new paths cannot reproduce, so ask the kernel again
+        self.current_directory = None
 
-            if not parsed_command:
-                continue
+        # Relative PATH entries now point somewhere else
+        self.forget_relative_directories()
 
-            command_keyword = parsed_command[0]
+    def read_command(self):
+        # On a terminal input() must own the prompt: readline writes it from
+        # C and needs it to redraw the line while editing. Piped input
+        # needs no line editor, so read the line directly
+        if self.interactive:
+            return input(PROMPT)
 
-            stdout_cm = open(stdout_file, stdout_mode) if stdout_file else None
-            stderr_cm = open(stderr_file, stderr_mode) if stderr_file else None
+        sys.stdout.write(PROMPT)
+        sys.stdout.flush()
+        line = sys.stdin.readline()
 
-            try:
-                with redirect_stdout(stdout_cm) if stdout_cm else self.dummy_cm(), (
-                    redirect_stderr(stderr_cm) if stderr_cm else self.dummy_cm()
-                ):
-                    if command_keyword in self.commands_map:
-                        try:
-                            self.commands_map[command_keyword](parsed_command)
-                        except Exception:
-                            print("Invalid command")
-                    else:
-                        path_directory = self.find_executable(command_keyword)
+        if not line:
+            raise EOFError
 
-                        if path_directory is None:
-                            print(f"{command}: command not found")
-                        else:
-                            try:
-                                self.run_executable(
-                                    path_directory,
-                                    parsed_command,
-                                    stdout_file=stdout_cm,
-                                    stderr_file=stderr_cm,
-                                )
-                            except Exception:
-                                print("Invalid command")
-            finally:
-                if stdout_cm:
-                    stdout_cm.close()
-                if stderr_cm:
-                    stderr_cm.close()
+        return line[:-1] if line.endswith("\n") else line
 
     def main_loop(self):
         while self.continue_repl:
             try:
-                command = input("$ ")
+                command = self.read_command()
             except EOFError:
-                print()
+                sys.stdout.write("\n")
                 break
 
             # add command to history
-            self.command_history.append(command)
+            self.add_history(command)
             # RUn command through pipeline
             self.run_pipeline(command)
 
     def run_pipeline(self, command_line):
-        segments = [seg.strip() for seg in command_line.split("|")]
-        num_segments = len(segments)
+        # An unbalanced quote or a trailing backslash rejects the whole
+        # line; the REPL carries on with the next one
+        try:
+            specs = self.parse_command_line(command_line)
+        except ValueError as e:
+            print(f"syntax error: {e}")
+            return
+
+        num_segments = len(specs)
         prev_output = None
         processes = []
-        stdout_cm = None
-        stderr_cm = None
-
-        for i, segment in enumerate(segments):
-            is_last = i == num_segments - 1
-            parsed_command = self.parse_command(segment)
-            # Only parse redirection on last segment
-            if is_last:
+        stdout_fd = None
+        stderr_fd = None
+        redirect_streams = []
+        pipe_feeders = []
+        # Every external stage is looked up before the first one starts, so
+        # a missing command is reported with no stage left running. A lone
+        # command given as a path names its file directly; checking it is
+        # left to posix_spawn and only repeated on failure
+        executable_paths = []
+
+        for parsed_command, *_ in specs:
+            command_keyword = parsed_command[0] if parsed_command else None
+
+            if command_keyword is None or command_keyword in self.commands_map:
+                executable_paths.append(None)
+                continue
+
+            if (
+                num_segments == 1
+                and os.sep in command_keyword
+                and hasattr(os, "posix_spawn")
+            ):
+                path_directory = command_keyword
+            else:
+                path_directory = self.find_executable(command_keyword)
+
+            if path_directory is None:
+                lone_spec = specs[0] if num_segments == 1 else None
+                self.report_not_found(command_keyword, lone_spec)
+                return
+
+            executable_paths.append(path_directory)
+
+        try:
+            for i, spec in enumerate(specs):
+                is_last = i == num_segments - 1
                 parsed_command, stdout_file, stdout_mode, stderr_file, stderr_mode = (
-                    self.parse_redirection(parsed_command)
+                    spec
                 )
-                if stdout_file:
-                    stdout_cm = open(stdout_file, stdout_mode)
-                if stderr_file:
-                    stderr_cm = open(stderr_file, stderr_mode)
-            if not parsed_command:
-                return
-            # command name
-            command_keyword = parsed_command[0]
-            # Built-in
-            if command_keyword in self.commands_map:
-                input_stream = prev_output if prev_output else None
-                output_stream = (
-                    io.StringIO()
-                    if not is_last
-                    else (stdout_cm if stdout_cm else sys.stdout)
+                # A lone external command is spawned directly and has its
+                # redirections opened by posix_spawn
+                spawn_directly = (
+                    num_segments == 1
+                    and parsed_command
+                    and parsed_command[0] not in self.commands_map
+                    and hasattr(os, "posix_spawn")
                 )
-                error_stream = stderr_cm if is_last and stderr_cm else sys.stderr
-                orig_stdin = sys.stdin
-                orig_stdout = sys.stdout
-                orig_stderr = sys.stderr
-                try:
-                    if input_stream:
-                        if (
-                            hasattr(input_stream, "seekable")
-                            and input_stream.seekable()
-                        ):
-                            input_stream.seek(0)
-                        sys.stdin = input_stream
-                    sys.stdout = output_stream
-                    sys.stderr = error_stream
-                    self.commands_map[command_keyword](parsed_command)
-                finally:
-                    sys.stdin = orig_stdin
-                    sys.stdout = orig_stdout
-                    sys.stderr = orig_stderr
-                if not is_last:
-                    # If next is external, use a real pipe
-                    next_is_external = False
-                    if i + 1 < num_segments:
-                        next_cmd = self.parse_command(segments[i + 1])
-                        if next_cmd and next_cmd[0] not in self.commands_map:
-                            next_is_external = True
-                    if next_is_external:
-                        r, w = os.pipe()
-                        wfile = os.fdopen(w, "w")
-                        orig_stdout = sys.stdout
-                        try:
-                            sys.stdout = wfile
-                            self.commands_map[command_keyword](parsed_command)
-                        finally:
-                            sys.stdout = orig_stdout
-                            wfile.close()
-                        prev_output = os.fdopen(r)
+                # Only the last segment carries redirections
+                if is_last and not spawn_directly:
+                    try:
+                        if stdout_file:
+                            stdout_fd = self.open_redirection(
+                                stdout_file, stdout_mode
+                            )
+                        if stderr_file:
+                            stderr_fd = self.open_redirection(
+                                stderr_file, stderr_mode
+                            )
+                    except OSError as e:
+                        print(f"{e.filename}: {e.strerror}")
+                        return
+                if not parsed_command:
+                    return
+                # command name
+                command_keyword = parsed_command[0]
+                builtin = self.commands_map.get(command_keyword)
+                # Built-in
+                if builtin is not None:
+                    if isinstance(prev_output, int):
+                        prev_output = os.fdopen(prev_output)
+                    input_stream = prev_output if prev_output else None
+                    next_command = () if is_last else specs[i + 1][0]
+                    # An external reader needs a real file descriptor
+                    feeds_external = (
+                        next_command and next_command[0] not in self.commands_map
+                    )
+                    if is_last:
+                        output_stream = sys.stdout
+                        if stdout_fd is not None:
+                            output_stream = self.wrap_redirection(stdout_fd)
+                            redirect_streams.append(output_stream)
                     else:
+                        output_stream = io.StringIO()
+                    error_stream = sys.stderr
+                    if is_last and stderr_fd is not None:
+                        error_stream = self.wrap_redirection(stderr_fd)
+                        redirect_streams.append(error_stream)
+                    orig_stdin = sys.stdin
+                    orig_stdout = sys.stdout
+                    orig_stderr = sys.stderr
+                    try:
+                        if input_stream:
+                            if (
+                                hasattr(input_stream, "seekable")
+                                and input_stream.seekable()
+                            ):
+                                input_stream.seek(0)
+                            sys.stdin = input_stream
+                        sys.stdout = output_stream
+                        sys.stderr = error_stream
+                        builtin(parsed_command)
+                    finally:
+                        sys.stdin = orig_stdin
+                        sys.stdout = orig_stdout
+                        sys.stderr = orig_stderr
+                    if input_stream:
+                        input_stream.close()
+                        prev_output = None
+                    if feeds_external:
+                        # Nothing reads the pipe until the next stages are
+                        # started, so a thread writes it while they run;
+                        # output beyond the pipe's capacity would block here
+                        pipe_read, pipe_write = os.pipe()
+                        self.grow_pipe(pipe_write)
+                        feeder = threading.Thread(
+                            target=self.feed_pipe,
+                            args=(pipe_write, output_stream.getvalue()),
+                        )
+                        feeder.start()
+                        pipe_feeders.append(feeder)
+                        prev_output = pipe_read
+                    elif not is_last:
                         output_stream.seek(0)
                         prev_output = output_stream
-            else:
-                # External
-                path_directory = self.find_executable(command_keyword)
-                if path_directory is None:
-                    print(f"{command_keyword}: command not found")
-                    return
-                if prev_output is not None:
-                    stdin = prev_output
                 else:
-                    stdin = None
-                stdout = (
-                    stdout_cm
-                    if is_last and stdout_cm
-                    else (subprocess.PIPE if not is_last else None)
-                )
-                stderr = stderr_cm if is_last and stderr_cm else None
-                try:
-                    proc = subprocess.Popen(
-                        parsed_command,
-                        executable=path_directory,
-                        stdin=stdin,
-                        stdout=stdout,
-                        stderr=stderr,
-                        text=True,
-                    )
-                    if not is_last:
-                        prev_output = proc.stdout
-                    processes.append(proc)
-                except Exception:
-                    print("Invalid command")
-                    return
-        for proc in processes:
-            proc.wait()
-        if stdout_cm:
-            stdout_cm.close()
-        if stderr_cm:
-            stderr_cm.close()
+                    # External, already looked up above
+                    path_directory = executable_paths[i]
+                    if spawn_directly:
+                        file_actions = self.redirection_actions(
+                            stdout_file, stdout_mode, stderr_file, stderr_mode
+                        )
+                        pid, path_directory = self.spawn_resolved(
+                            command_keyword,
+                            path_directory,
+                            lambda path: self.spawn_executable(
+                                path, parsed_command, file_actions
+                            ),
+                        )
+                        if pid is None:
+                            if path_directory is None:
+                                self.report_not_found(command_keyword, spec)
+                                return
+                            error = self.redirection_error(
+                                stdout_file, stdout_mode, stderr_file, stderr_mode
+                            )
+                            print(error or "Invalid command")
+                            return
+                        os.waitpid(pid, 0)
+                        return
+                    stdin = prev_output
+                    # Stages are wired with raw pipe descriptors, so data
+                    # between two external commands never passes through
+                    # Python and needs no decoding
+                    if is_last:
+                        stdout = stdout_fd
+                        next_output = None
+                    else:
+                        next_output, stdout = os.pipe()
+                        self.grow_pipe(stdout)
+                    stderr = stderr_fd if is_last else None
+                    try:
+                        stage, path_directory = self.spawn_resolved(
+                            command_keyword,
+                            path_directory,
+                            lambda path: self.start_stage(
+                                path, parsed_command, stdin, stdout, stderr
+                            ),
+                        )
+                    finally:
+                        # The children hold their own copies; ours would
+                        # keep readers from seeing EOF and writers from
+                        # getting SIGPIPE
+                        if not is_last:
+                            os.close(stdout)
+                        self.close_stream(prev_output)
+                        prev_output = None
+                    if stage is None:
+                        if path_directory is None:
+                            print(f"{command_keyword}: command not found")
+                        else:
+                            print("Invalid command")
+                        if next_output is not None:
+                            os.close(next_output)
+                        return
+                    processes.append(stage)
+                    prev_output = next_output
+        finally:
+            self.close_stream(prev_output)
+            for stage in processes:
+                self.wait_stage(stage)
+            for feeder in pipe_feeders:
+                feeder.join()
+            # Flush what builtins wrote before the descriptors go away
+            for stream in redirect_streams:
+                stream.close()
+            if stdout_fd is not None:
+                os.close(stdout_fd)
+            if stderr_fd is not None:
+                os.close(stderr_fd)
+
+    def report_not_found(self, command_keyword, spec=None):
+        # As in other shells, a lone command's redirections are applied
+        # before the command is searched for, so `nosuch > out` still
+        # creates or truncates out, and a bad target is reported instead
+        error = None
+
+        if spec is not None:
+            error = self.redirection_error(*spec[1:])
+
+        print(error or f"{command_keyword}: command not found")
+
+    def feed_pipe(self, fd, text):
+        try:
+            writer = DescriptorWriter(fd)
+            writer.write(text)
+            writer.close()
+        except OSError:
+            # The reader exited without consuming everything
+            pass
+        finally:
+            os.close(fd)
+
+    def close_stream(self, stream):
+        # Pipeline stages hand over raw descriptors as well as file objects
+        if stream is None:
+            return
+        if isinstance(stream, int):
+            os.close(stream)
+        else:
+            stream.close()
 
 
 def main():